@@ -1,88 +1,276 @@
+import base64
 import bcrypt
-import secrets
+import jwt
+import os
+import pymysql
+import threading
 import time
-from typing import Optional, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Final, Iterable, Optional, Dict, Tuple
+from cachetools import TTLCache
 from db import get_conn
+from avatars import save_avatar_file, delete_avatar_file
 
 # =========================
 # 内部工具函数
 # =========================
 
+# bcrypt 代价因子，每 +1 耗时翻倍；默认 12（和现有哈希一致），线上按机器性能用 BCRYPT_COST 调
+BCRYPT_COST: Final = int(os.getenv("BCRYPT_COST", "12"))
+
+# 热路径上用到的库函数预先绑定成模块级名字，省掉每次调用的属性查找
+_hashpw: Final = bcrypt.hashpw
+_gensalt: Final = bcrypt.gensalt
+_checkpw: Final = bcrypt.checkpw
+
+# bcrypt 是纯 CPU 计算（会释放 GIL），放到一个大小 = CPU 核数的专用线程池里跑：
+# 多核并行，同时避免几十个请求线程一起算 bcrypt 把 CPU 挤爆、拖慢其它接口
+_BCRYPT_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="bcrypt")
+
 def _hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    salt = _gensalt(rounds=BCRYPT_COST)
+    return _BCRYPT_POOL.submit(_hashpw, password.encode("utf-8"), salt).result().decode("utf-8")
 
 def _verify_password(password: str, password_hash: str) -> bool:
-    return bcrypt.checkpw(password.encode("utf-8"), password_hash.encode("utf-8"))
+    # bcrypt 哈希固定 60 个字符，格式不对的（脏数据 / 迁移残留）直接判失败，不白跑一轮 bcrypt
+    if not password_hash or len(password_hash) != 60 or not password_hash.startswith(("$2a$", "$2b$", "$2y$")):
+        return False
+    return _BCRYPT_POOL.submit(_checkpw, password.encode("utf-8"), password_hash.encode("utf-8")).result()
+
+# 24 字节随机数 -> 32 个 url-safe 字符，长度是 3 的倍数所以没有 '=' 填充，
+# 省掉 secrets.token_urlsafe 里的 rstrip/decode 包装；192 bit 熵对会话足够
+_urandom: Final = os.urandom
+_b64encode: Final = base64.urlsafe_b64encode
+
+def _new_token() -> str:
+    return _b64encode(_urandom(24)).decode("ascii")
+
+def _needs_rehash(password_hash: str) -> bool:
+    # bcrypt 哈希格式: $2b$12$<salt+hash>，第三段就是代价因子
+    # 只往上升级：BCRYPT_COST 调低时不能把已有的高代价哈希降级
+    try:
+        return int(password_hash.split("$")[2]) < BCRYPT_COST
+    except (IndexError, ValueError):
+        return True
 
 # =========================
 # 用户查询
 # =========================
 
-def get_user_by_username(username: str) -> Optional[Dict]:
+# 注意：老数据里 avatar 可能还是 LONGTEXT Base64，不要 SELECT *，否则每次登录都要把整张图拖回来
+
+def get_user_by_username(username: str) -> Optional[Tuple[int, str]]:
+    """登录校验用，只取 (id, password_hash)；用元组游标，省掉每行构造 dict"""
     conn = get_conn()
     try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT * FROM dreams_users WHERE username=%s", (username,))
+        with conn.cursor(pymysql.cursors.Cursor) as cur:
+            cur.execute(
+                "SELECT id, password_hash FROM dreams_users WHERE username=%s LIMIT 1",
+                (username,),
+            )
             return cur.fetchone()
     finally:
         conn.close()
 
+# 用户资料的进程内缓存：目前没有修改资料的接口，资料注册后就不变，TTL 只是兜底
+_user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_user_lock = threading.Lock()
+
 def get_user_by_id(uid: int) -> Optional[Dict]:
+    """用户资料（含头像），只在确实需要展示时调用；返回的 dict 是缓存共享的，调用方不要修改"""
+    with _user_lock:
+        user = _user_cache.get(uid)
+    if user is not None:
+        return user
+
     conn = get_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM dreams_users WHERE id=%s", (uid,))
-            return cur.fetchone()
+            cur.execute(
+                "SELECT id, username, avatar, gender, created_at FROM dreams_users WHERE id=%s LIMIT 1",
+                (uid,),
+            )
+            user = cur.fetchone()
     finally:
         conn.close()
 
-# =========================
-# 用户创建 (含 Gender)
-# =========================
+    # 不存在的用户不缓存，注册后马上就能查到
+    if user is not None:
+        with _user_lock:
+            _user_cache[uid] = user
+    return user
+
+# 用户名 / 头像的进程内缓存（会话列表、消息里展示别人用），这两项很少变
+_user_brief_cache: TTLCache = TTLCache(maxsize=50_000, ttl=60)
+_user_brief_lock = threading.Lock()
+
+def get_user_briefs(uids: Iterable[int]) -> Dict[int, Dict]:
+    """批量取 {uid: {"id", "username", "avatar"}}，缓存未命中的一次 IN 查询补齐"""
+    result: Dict[int, Dict] = {}
+    missing = []
+    with _user_brief_lock:
+        for uid in set(uids):
+            brief = _user_brief_cache.get(uid)
+            if brief is None:
+                missing.append(uid)
+            else:
+                result[uid] = brief
+    if not missing:
+        return result
 
-def create_user(username: str, password: str, avatar: Optional[str], gender: str = 'secret') -> int:
     conn = get_conn()
     try:
         with conn.cursor() as cur:
-            # ✨ 核心修改：直接把 avatar (Base64字符串) 存入数据库
-            # 不需要 save_avatar_file 了，因为数据库已经够大了 (LONGTEXT)
             cur.execute(
-                """
-                INSERT INTO dreams_users (username, password_hash, avatar, gender)
-                VALUES (%s, %s, %s, %s)
-                """,
-                (username, _hash_password(password), avatar, gender),
+                "SELECT id, username, avatar FROM dreams_users WHERE id IN %s",
+                (tuple(missing),),
             )
-            conn.commit()
-            return cur.lastrowid
+            rows = cur.fetchall()
     finally:
         conn.close()
 
+    with _user_brief_lock:
+        for r in rows:
+            _user_brief_cache[r["id"]] = r
+            result[r["id"]] = r
+    return result
+
 # =========================
 # Token 管理
 # =========================
 
-def issue_token(uid: int) -> str:
-    token = secrets.token_urlsafe(32)
+# 会话有效期（天），过期的 token 查不到，并由后台任务定期清理
+SESSION_TTL_DAYS: Final = int(os.getenv("SESSION_TTL_DAYS", "30"))
+
+# 每次最多删多少行，避免一次大 DELETE 长时间锁表
+SESSION_PURGE_BATCH: Final = 10000
+
+# dreams_sessions.token 列现在存的是 JWT 的 jti（会话 ID）：行在 token 才有效，删掉就是吊销
+_INSERT_SESSION_SQL = (
+    "INSERT INTO dreams_sessions (uid, token, expires_at) "
+    "VALUES (%s, %s, NOW() + INTERVAL %s DAY)"
+)
+
+# JWT 签名密钥；多实例 / 多 worker 部署必须配置成同一个值
+# 没配置直接启动失败：用随机密钥的话每次重启都会把所有人踢下线，多 worker 时 token 还会随机失效
+JWT_SECRET: Final = os.getenv("JWT_SECRET") or ""
+JWT_ALGORITHM: Final = "HS256"
+if not JWT_SECRET:
+    raise RuntimeError("JWT_SECRET is not set")
+
+def _sign_token(uid: int, jti: str) -> str:
+    return jwt.encode(
+        {"uid": uid, "jti": jti, "exp": int(time.time()) + SESSION_TTL_DAYS * 86400},
+        JWT_SECRET,
+        algorithm=JWT_ALGORITHM,
+    )
+
+# token 对应的会话行 -> uid 的进程内缓存：JWT 用 jti 查，JWT 上线前签发的旧版不透明 token 直接用 token 查
+# key 是 _new_token() 生成的高熵随机串，直接当 key 不会撞；
+# 退出登录只删数据库里的行，其它进程要等缓存过期才能感知，所以 TTL 就是吊销的最长生效延迟
+_token_cache: TTLCache = TTLCache(maxsize=100_000, ttl=60)
+_token_cache_lock = threading.Lock()
+
+def get_uid_by_token(token: str) -> Optional[int]:
+    """
+    校验 token，返回 uid
+
+    JWT 先做本地 HMAC 验签 + 过期检查，再确认 jti 对应的会话行还在（没退出登录）；
+    会话行查询有进程内缓存，同一个 token 每分钟最多查一次库。
+    不含 '.' 的是旧版不透明 token，直接走 dreams_sessions 查询
+    """
+    if not token:
+        return None
+
+    if token.count(".") == 2:
+        try:
+            claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        except jwt.InvalidTokenError:
+            return None
+        uid = int(claims["uid"])
+        return uid if _get_uid_by_session_token(claims["jti"]) == uid else None
+
+    return _get_uid_by_session_token(token)
+
+def _get_uid_by_session_token(token: str) -> Optional[int]:
+    with _token_cache_lock:
+        uid = _token_cache.get(token)
+    if uid is not None:
+        return uid
+
     conn = get_conn()
     try:
-        with conn.cursor() as cur:
+        # 单行单列的热点查询，用元组游标而不是 DictCursor
+        with conn.cursor(pymysql.cursors.Cursor) as cur:
             cur.execute(
-                "INSERT INTO dreams_sessions (uid, token) VALUES (%s, %s)",
-                (uid, token),
+                "SELECT uid FROM dreams_sessions WHERE token=%s AND expires_at > NOW() LIMIT 1",
+                (token,),
+            )
+            row = cur.fetchone()
+    finally:
+        conn.close()
+
+    if not row:
+        # 无效 token 不缓存，避免被随机串刷爆缓存
+        return None
+
+    uid = int(row[0])
+    with _token_cache_lock:
+        _token_cache[token] = uid
+    return uid
+
+def revoke_token(token: str) -> None:
+    """
+    吊销 token（退出登录时调用）
+
+    删掉会话行后所有进程都会拒绝这个 token；本进程立即生效，
+    其它进程最多晚 _token_cache 的 TTL（60 秒）
+    """
+    if not token:
+        return
+    if token.count(".") == 2:
+        try:
+            claims = jwt.decode(
+                token, JWT_SECRET, algorithms=[JWT_ALGORITHM],
+                options={"verify_exp": False},
             )
+        except jwt.InvalidTokenError:
+            return
+        key = claims.get("jti")
+        if not key:
+            return
+    else:
+        key = token
+    with _token_cache_lock:
+        _token_cache.pop(key, None)
+
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM dreams_sessions WHERE token=%s", (key,))
             conn.commit()
-        return token
     finally:
         conn.close()
 
-def get_uid_by_token(token: str) -> Optional[int]:
+def purge_expired_sessions() -> int:
+    """
+    分批删除过期会话，返回删除的行数
+
+    dreams_sessions 每次登录都会插一行，不清理的话 token 索引会无限膨胀
+    """
+    total = 0
     conn = get_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT uid FROM dreams_sessions WHERE token=%s", (token,))
-            row = cur.fetchone()
-            return int(row["uid"]) if row else None
+            while True:
+                cur.execute(
+                    "DELETE FROM dreams_sessions WHERE expires_at < NOW() LIMIT %s",
+                    (SESSION_PURGE_BATCH,),
+                )
+                conn.commit()
+                total += cur.rowcount
+                if cur.rowcount < SESSION_PURGE_BATCH:
+                    return total
     finally:
         conn.close()
 
@@ -94,59 +282,124 @@ def register(username: str, password: str, avatar: Optional[str], gender: str =
     if not username or not password:
         raise ValueError("username and password required")
 
-    existing = get_user_by_username(username)
-    if existing:
-        raise ValueError("username already exists")
+    # bcrypt 和头像落盘都放在事务外面做，避免拿着连接干等
+    password_hash = _hash_password(password)
+    avatar = save_avatar_file(avatar)
+    jti = _new_token()
 
-    # 1. 创建用户 (Base64 直接存库，不再存文件)
-    uid = create_user(username, password, avatar, gender)
-    
-    # 2. 签发 Token
-    token = issue_token(uid)
-
-    # 3. 自动加入世界频道
-    # 使用 try-except 防止因 import 循环或群不存在导致注册失败
+    # 创建用户 + 签发 Token + 加入世界频道：同一个连接、同一个事务
+    # 不再先 SELECT 查重，直接依赖 username 的 UNIQUE 索引，撞了就是重名
+    conn = get_conn()
     try:
-        from conversations import add_member
-        # 参数说明: operator_uid=1 (群主操作), cid=1 (世界频道), new_uid=uid (新注册用户)
-        # 强制用 UID 1 把新人拉进群，避免权限问题
-        add_member(1, 1, uid) 
-    except Exception as e:
-        print(f"Auto-join world channel failed: {e}")
+        with conn.cursor() as cur:
+            conn.begin()
+            try:
+                cur.execute(
+                    """
+                    INSERT INTO dreams_users (username, password_hash, avatar, gender)
+                    VALUES (%s, %s, %s, %s)
+                    """,
+                    (username, password_hash, avatar, gender),
+                )
+                uid = cur.lastrowid
+                cur.execute(_INSERT_SESSION_SQL, (uid, jti, SESSION_TTL_DAYS))
+                # 自动加入世界频道 (cid=1)
+                # 用 INSERT ... SELECT：世界频道不存在时插 0 行，不会让注册失败
+                cur.execute(
+                    """
+                    INSERT IGNORE INTO dreams_conversation_members (conversation_id, uid)
+                    SELECT id, %s FROM dreams_conversations WHERE id = 1
+                    """,
+                    (uid,),
+                )
+                conn.commit()
+            except pymysql.err.IntegrityError:
+                conn.rollback()
+                delete_avatar_file(avatar)
+                raise ValueError("username already exists")
+            except Exception:
+                conn.rollback()
+                delete_avatar_file(avatar)
+                raise
+    finally:
+        conn.close()
+
+    token = _sign_token(uid, jti)
 
     return {
         "uid": uid,
         "token": token,
-        "avatar": avatar, # 直接返回 Base64 供前端立即显示
+        "avatar": avatar, # 头像 URL，前端可立即显示
         "gender": gender
     }
 
-def login(username: str, password: str) -> Dict:
+# 登录失败计数（60 秒窗口），超过就直接拒绝，不再跑 bcrypt，防止撞库时对方用我们的 CPU 来算哈希：
+# - 同一用户名 + 同一来源 IP：阈值低，别人刷错密码锁不住从其它地方登录的账号主人
+# - 同一用户名（不管来源）：阈值高，兜住换 IP 分散撞同一个账号的情况
+LOGIN_MAX_FAILURES: Final = 10
+LOGIN_MAX_FAILURES_PER_USER: Final = 100
+_login_failures: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_login_failures_lock = threading.Lock()
+
+def _record_login_failure(username: str, client_ip: str) -> None:
+    with _login_failures_lock:
+        for key in ((username, client_ip), username):
+            _login_failures[key] = _login_failures.get(key, 0) + 1
+
+def _login_blocked(username: str, client_ip: str) -> bool:
+    with _login_failures_lock:
+        return (
+            _login_failures.get((username, client_ip), 0) >= LOGIN_MAX_FAILURES
+            or _login_failures.get(username, 0) >= LOGIN_MAX_FAILURES_PER_USER
+        )
+
+def login(username: str, password: str, client_ip: str = "") -> Dict:
     if not username or not password:
         raise ValueError("username and password required")
 
+    if _login_blocked(username, client_ip):
+        raise ValueError("too many failed attempts, try again later")
+
     user = get_user_by_username(username)
     if not user:
         raise ValueError("user not found")
 
-    if not _verify_password(password, user["password_hash"]):
+    uid, password_hash = int(user[0]), user[1]
+
+    if not _verify_password(password, password_hash):
+        _record_login_failure(username, client_ip)
         raise ValueError("wrong password")
 
-    uid = int(user["id"])
+    # 代价因子低于当前配置的老哈希，登录成功时顺手用新参数重算
+    new_hash = _hash_password(password) if _needs_rehash(password_hash) else None
+
+    jti = _new_token()
 
-    # 更新登录时间
+    # 更新登录时间 + 签发 Token：同一个连接、同一个事务
     conn = get_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute("UPDATE dreams_users SET last_login_at=NOW() WHERE id=%s", (uid,))
-            conn.commit()
+            conn.begin()
+            try:
+                if new_hash:
+                    cur.execute(
+                        "UPDATE dreams_users SET last_login_at=NOW(), password_hash=%s WHERE id=%s",
+                        (new_hash, uid),
+                    )
+                else:
+                    cur.execute("UPDATE dreams_users SET last_login_at=NOW() WHERE id=%s", (uid,))
+                cur.execute(_INSERT_SESSION_SQL, (uid, jti, SESSION_TTL_DAYS))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
     finally:
         conn.close()
 
-    token = issue_token(uid)
+    token = _sign_token(uid, jti)
 
+    # 头像不在登录结果里返回，前端需要时走 /api/me
     return {
         "uid": uid,
         "token": token,
-        "avatar": user.get("avatar")
     }
@@ -0,0 +1,74 @@
+import binascii
+import os
+import re
+import uuid
+from typing import Optional
+
+# =========================
+# 头像文件存储
+# =========================
+# 前端上传的是 data:image/...;base64,... 字符串。
+# 整串 Base64 塞在 LONGTEXT 里，每次查用户都要把图拖一遍；
+# 配置了 AVATAR_STORAGE_DIR 时解码成二进制文件放到那个目录，数据库只存一个短 URL。
+#
+# AVATAR_STORAGE_DIR 必须是持久化存储（挂载的卷）：Railway 这类平台的容器文件系统
+# 重新部署就清空，文件没了而数据库里只剩 URL，头像就永久丢了。
+# 没配置时不落盘，头像照旧以 data URL 存在数据库里。
+
+AVATAR_DIR: Optional[str] = os.getenv("AVATAR_STORAGE_DIR") or None
+AVATAR_URL_PREFIX = "/uploads/avatars/"
+
+_DATA_URL_RE = re.compile(r"data:image/(png|jpe?g|gif|webp);base64,")
+
+# 分块解码，块大小必须是 4 的倍数（Base64 每 4 个字符对应 3 个字节）
+_DECODE_CHUNK = 64 * 1024
+
+if AVATAR_DIR:
+    os.makedirs(AVATAR_DIR, exist_ok=True)
+
+
+def save_avatar_file(avatar: Optional[str]) -> Optional[str]:
+    """
+    把 Base64 头像落盘，返回可以直接给 <img src> 用的 URL
+
+    - 空值 -> None
+    - 没配置 AVATAR_STORAGE_DIR / 已经是 URL（不是 data: 开头）-> 原样返回
+    - data:image/...;base64,... -> 解码写文件，返回 /uploads/avatars/xxx.ext
+    """
+    if not avatar:
+        return None
+    if not AVATAR_DIR:
+        return avatar
+
+    m = _DATA_URL_RE.match(avatar)
+    if not m:
+        if avatar.startswith("data:"):
+            raise ValueError("unsupported avatar format")
+        return avatar
+
+    ext = "jpg" if m.group(1) in ("jpg", "jpeg") else m.group(1)
+    filename = f"{uuid.uuid4().hex}.{ext}"
+    path = os.path.join(AVATAR_DIR, filename)
+
+    # 不做 split(",") 也不一次性 b64decode 整串：
+    # 按块切片解码直接写文件，峰值内存只有一个块
+    start = m.end()
+    try:
+        with open(path, "wb") as f:
+            for i in range(start, len(avatar), _DECODE_CHUNK):
+                f.write(binascii.a2b_base64(avatar[i:i + _DECODE_CHUNK]))
+    except binascii.Error:
+        os.remove(path)
+        raise ValueError("invalid avatar data")
+
+    return AVATAR_URL_PREFIX + filename
+
+
+def delete_avatar_file(url: Optional[str]) -> None:
+    """删除 save_avatar_file 生成的文件（例如注册失败回滚时）"""
+    if not AVATAR_DIR or not url or not url.startswith(AVATAR_URL_PREFIX):
+        return
+    try:
+        os.remove(os.path.join(AVATAR_DIR, os.path.basename(url)))
+    except FileNotFoundError:
+        pass
@@ -1,180 +1,242 @@
-from typing import List, Dict, Optional
+import threading
+from typing import List, Dict, Optional, Tuple
+from cachetools import TTLCache
 from db import get_conn
+from auth import get_user_briefs
+from avatars import save_avatar_file, delete_avatar_file
 import pymysql # 引入这个是为了捕获具体的数据库错误
 
+# ================= 0. 成员关系缓存 =================
+# is_member 在每次 WS 握手 / 拉消息 / 拉成员时都要查，结果只在加人 / 踢人时变化，
+# 用短 TTL 缓存挡住大部分查询；本进程内的增删成员会同步更新缓存
+_membership_cache: "TTLCache[Tuple[int, int], bool]" = TTLCache(maxsize=10_000, ttl=30)
+_membership_lock = threading.Lock()
+
+def _set_membership(uid: int, cid: int, value: bool):
+    with _membership_lock:
+        _membership_cache[(uid, cid)] = value
+
 # ================= 1. 基础创建 =================
 
 def create_private(uid1: int, uid2: int) -> int:
-    conn = get_conn()
-    try:
-        with conn.cursor() as cur:
-            # 检查私聊是否已存在
-            cur.execute("""
-                SELECT c.id FROM dreams_conversations c
-                JOIN dreams_conversation_members m1 ON c.id = m1.conversation_id
-                JOIN dreams_conversation_members m2 ON c.id = m2.conversation_id
-                WHERE c.type = 'private' AND m1.uid = %s AND m2.uid = %s
-            """, (uid1, uid2))
-            existing = cur.fetchone()
-            if existing: return existing["id"]
-
-            # 创建新私聊
-            cur.execute("INSERT INTO dreams_conversations (type) VALUES ('private')")
+    # 私聊用 "小uid-大uid" 作为唯一键，get-or-create 一条语句完成：
+    # 已存在时 ON DUPLICATE KEY 把 LAST_INSERT_ID 设成已有的 id，不会并发建出两个私聊
+    pair_key = f"{min(uid1, uid2)}-{max(uid1, uid2)}"
+    with get_conn() as conn, conn.cursor() as cur:
+        conn.begin()
+        try:
+            cur.execute(
+                """
+                INSERT INTO dreams_conversations (type, private_pair_key) VALUES ('private', %s)
+                ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+                """,
+                (pair_key,),
+            )
             cid = cur.lastrowid
-            cur.execute("INSERT INTO dreams_conversation_members (conversation_id, uid) VALUES (%s, %s), (%s, %s)", (cid, uid1, cid, uid2))
+            cur.execute("INSERT IGNORE INTO dreams_conversation_members (conversation_id, uid) VALUES (%s, %s), (%s, %s)", (cid, uid1, cid, uid2))
             conn.commit()
-            return cid
-    finally:
-        conn.close()
+        except Exception:
+            conn.rollback()
+            raise
+        _set_membership(uid1, cid, True)
+        _set_membership(uid2, cid, True)
+        return cid
 
 def create_group(owner_uid: int, title: str) -> int:
-    conn = get_conn()
-    try:
-        with conn.cursor() as cur:
-            # 创建群并指定群主
-            cur.execute("INSERT INTO dreams_conversations (type, title, owner_uid) VALUES ('group', %s, %s)", (title, owner_uid))
-            cid = cur.lastrowid
-            cur.execute("INSERT INTO dreams_conversation_members (conversation_id, uid, role) VALUES (%s, %s, 'owner')", (cid, owner_uid))
-            conn.commit()
-            return cid
-    finally:
-        conn.close()
+    with get_conn() as conn, conn.cursor() as cur:
+        # 创建群并指定群主
+        cur.execute("INSERT INTO dreams_conversations (type, title, owner_uid) VALUES ('group', %s, %s)", (title, owner_uid))
+        cid = cur.lastrowid
+        cur.execute("INSERT INTO dreams_conversation_members (conversation_id, uid, role) VALUES (%s, %s, 'owner')", (cid, owner_uid))
+        conn.commit()
+        _set_membership(owner_uid, cid, True)
+        return cid
 
 # ================= 2. 列表查询 =================
 
-def list_conversations(uid: int) -> List[Dict]:
-    conn = get_conn()
-    try:
-        with conn.cursor() as cur:
-            sql = """
-            SELECT 
-                c.id, c.type, c.title, c.avatar as group_avatar, c.updated_at,
-                m.is_pinned, m.is_muted, m.last_read_at, m.role as my_role,
-                
-                (SELECT COUNT(*) FROM dreams_messages msg 
-                 WHERE msg.conversation_id = c.id AND msg.created_at > m.last_read_at
-                ) as unread_count,
-                
-                (SELECT content FROM dreams_messages msg 
-                 WHERE msg.conversation_id = c.id ORDER BY msg.created_at DESC LIMIT 1
-                ) as last_message,
-                
-                (SELECT created_at FROM dreams_messages msg 
-                 WHERE msg.conversation_id = c.id ORDER BY msg.created_at DESC LIMIT 1
-                ) as last_message_time,
-
-                u_peer.username as peer_name,
-                u_peer.avatar as peer_avatar,
-                u_peer.id as peer_uid
-
-            FROM dreams_conversation_members m
-            JOIN dreams_conversations c ON m.conversation_id = c.id
-            
-            LEFT JOIN dreams_conversation_members m_peer 
-                ON c.id = m_peer.conversation_id 
-                AND c.type = 'private' 
-                AND m_peer.uid != %s
-                
-            LEFT JOIN dreams_users u_peer ON m_peer.uid = u_peer.id
-            
-            WHERE m.uid = %s
-            ORDER BY m.is_pinned DESC, COALESCE(last_message_time, c.updated_at) DESC
-            """
-            cur.execute(sql, (uid, uid))
-            rows = cur.fetchall()
+def _format_conversation(r: Dict, peers: Dict[int, Dict]) -> Dict:
+    display_title = r["title"]
+    display_avatar = r["group_avatar"]
+    
+    if r["type"] == 'private':
+        peer = peers.get(r["peer_uid"]) or {}
+        display_title = peer.get("username") or "未知用户"
+        display_avatar = peer.get("avatar")
+    
+    return {
+        "id": r["id"], 
+        "type": r["type"], 
+        "title": display_title, 
+        "avatar": display_avatar,
+        "peer_uid": r["peer_uid"], 
+        "is_pinned": bool(r["is_pinned"]), 
+        "is_muted": bool(r["is_muted"]),
+        "unread": r["unread_count"], 
+        "last_msg": r["last_message"] or "", 
+        "last_time": r["last_message_time"],
+        "my_role": r["my_role"]
+    }
+
+def list_conversations(uid: int, limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
+    """
+    会话列表；limit 为空时返回全部（保持旧接口行为），否则在数据库里分页
+    """
+    # 结果要整批拿去补对方资料，本来就得全部读进内存，用普通游标一次 fetchall；
+    # 控制内存靠的是 limit 分页，不是游标类型
+    with get_conn() as conn, conn.cursor() as cur:
+        # 最后一条消息 / 未读数都直接读冗余列（save_messages 时同步写入），
+        # 整个查询不碰 dreams_messages。
+        # 对方 uid 用 CASE 包住的相关子查询取：只有私聊行才会去查成员表，
+        # 群聊（尤其是成员很多的世界频道）不再白白 JOIN 一遍所有成员。
+        # 对方的用户名 / 头像不在 SQL 里 JOIN，查完后按 uid 批量补（有缓存）。
+        # 排序键 sort_at 存在成员表上，ORDER BY 直接走 idx_uid_sort 倒序扫描，不用 filesort
+        sql = """
+        SELECT 
+            c.id, c.type, c.title, c.avatar as group_avatar, c.updated_at,
+            m.is_pinned, m.is_muted, m.last_read_at, m.role as my_role,
             
-            results = []
-            for r in rows:
-                display_title = r["title"]
-                display_avatar = r["group_avatar"]
-                
-                if r["type"] == 'private':
-                    display_title = r["peer_name"] or "未知用户"
-                    display_avatar = r["peer_avatar"]
-                
-                results.append({
-                    "id": r["id"], 
-                    "type": r["type"], 
-                    "title": display_title, 
-                    "avatar": display_avatar,
-                    "peer_uid": r["peer_uid"], 
-                    "is_pinned": bool(r["is_pinned"]), 
-                    "is_muted": bool(r["is_muted"]),
-                    "unread": r["unread_count"], 
-                    "last_msg": r["last_message"] or "", 
-                    "last_time": r["last_message_time"],
-                    "my_role": r["my_role"]
-                })
-            return results
-    finally:
-        conn.close()
+            m.unread_count,
+            c.last_message_preview as last_message,
+            c.last_message_at as last_message_time,
+
+            CASE WHEN c.type = 'private' THEN (
+                SELECT m_peer.uid FROM dreams_conversation_members m_peer
+                WHERE m_peer.conversation_id = c.id AND m_peer.uid != %s
+                LIMIT 1
+            ) END as peer_uid
+
+        FROM dreams_conversation_members m
+        JOIN dreams_conversations c ON m.conversation_id = c.id
+        WHERE m.uid = %s
+        ORDER BY m.is_pinned DESC, m.sort_at DESC
+        """
+        params = [uid, uid]
+        if limit is not None:
+            sql += " LIMIT %s OFFSET %s"
+            params += [limit, offset]
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+
+    peers = get_user_briefs(r["peer_uid"] for r in rows if r["peer_uid"])
+    return [_format_conversation(r, peers) for r in rows]
 
 # ================= 3. 管理功能 =================
 
 def update_group_info(operator_uid: int, cid: int, title: str = None, avatar: str = None):
-    conn = get_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT role FROM dreams_conversation_members WHERE conversation_id=%s AND uid=%s", (cid, operator_uid))
-            row = cur.fetchone()
-            if not row or row["role"] != 'owner':
-                raise PermissionError("只有群主可以修改群信息")
-            
-            if title: cur.execute("UPDATE dreams_conversations SET title=%s WHERE id=%s", (title, cid))
-            if avatar: cur.execute("UPDATE dreams_conversations SET avatar=%s WHERE id=%s", (avatar, cid))
+    with get_conn() as conn, conn.cursor() as cur:
+        # 旧头像顺便查出来，换头像后删掉旧文件；只取前 255 个字符：
+        # 文件 URL 很短，内联的 data URL 不用整串拖回来（截断后也不会被当成文件删）
+        cur.execute(
+            """
+            SELECT m.role, LEFT(c.avatar, 255) AS old_avatar
+            FROM dreams_conversation_members m
+            JOIN dreams_conversations c ON c.id = m.conversation_id
+            WHERE m.conversation_id=%s AND m.uid=%s
+            """,
+            (cid, operator_uid),
+        )
+        row = cur.fetchone()
+        if not row or row["role"] != 'owner':
+            raise PermissionError("只有群主可以修改群信息")
+        
+        # 改名 + 改头像合并成一条 UPDATE
+        # 群头像和用户头像一样处理（配置了持久化存储就落盘，表里只存 URL）
+        sets, params = [], []
+        if title:
+            sets.append("title=%s"); params.append(title)
+        avatar_url = save_avatar_file(avatar) if avatar else None
+        if avatar_url:
+            sets.append("avatar=%s"); params.append(avatar_url)
+        if not sets: return
+
+        try:
+            cur.execute(f"UPDATE dreams_conversations SET {', '.join(sets)} WHERE id=%s", (*params, cid))
             conn.commit()
-    finally:
-        conn.close()
+        except Exception:
+            delete_avatar_file(avatar_url)
+            raise
+        if avatar_url and row["old_avatar"] != avatar_url:
+            delete_avatar_file(row["old_avatar"])
 
 def remove_member(operator_uid: int, cid: int, target_uid: int):
-    conn = get_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT role FROM dreams_conversation_members WHERE conversation_id=%s AND uid=%s", (cid, operator_uid))
-            op = cur.fetchone()
-            if not op: raise PermissionError("你不在群里")
-            
-            cur.execute("SELECT role FROM dreams_conversation_members WHERE conversation_id=%s AND uid=%s", (cid, target_uid))
-            target = cur.fetchone()
-            if not target: return 
+    with get_conn() as conn, conn.cursor() as cur:
+        # 操作者和目标的角色一次查出来
+        cur.execute(
+            "SELECT uid, role FROM dreams_conversation_members WHERE conversation_id=%s AND uid IN (%s, %s)",
+            (cid, operator_uid, target_uid),
+        )
+        roles = {r["uid"]: r["role"] for r in cur.fetchall()}
 
-            allowed = (op["role"] == 'owner') or (op["role"] == 'admin' and target["role"] == 'member')
-            if not allowed:
-                raise PermissionError("权限不足，无法移除该成员")
+        op_role = roles.get(operator_uid)
+        if not op_role: raise PermissionError("你不在群里")
 
-            cur.execute("DELETE FROM dreams_conversation_members WHERE conversation_id=%s AND uid=%s", (cid, target_uid))
-            conn.commit()
-    finally:
-        conn.close()
+        target_role = roles.get(target_uid)
+        if not target_role: return 
+
+        allowed = (op_role == 'owner') or (op_role == 'admin' and target_role == 'member')
+        if not allowed:
+            raise PermissionError("权限不足，无法移除该成员")
+
+        cur.execute("DELETE FROM dreams_conversation_members WHERE conversation_id=%s AND uid=%s", (cid, target_uid))
+        conn.commit()
+        _set_membership(target_uid, cid, False)
 
 def add_member(operator_uid: int, cid: int, new_uid: int):
-    conn = get_conn()
-    try:
-        with conn.cursor() as cur:
-            if cid != 1:
-                cur.execute("SELECT role FROM dreams_conversation_members WHERE conversation_id=%s AND uid=%s", (cid, operator_uid))
-                row = cur.fetchone()
-                if not row: pass 
-
-            # ✨ 修复：不再使用 IGNORE，确保数据写入，并强制转 int 防止类型错误
-            try:
-                cur.execute("INSERT INTO dreams_conversation_members (conversation_id, uid) VALUES (%s, %s)", (cid, int(new_uid)))
-                conn.commit()
-            except pymysql.err.IntegrityError:
-                # 如果已经存在，直接忽略，不报错（相当于 IGNORE，但更可控）
-                pass
-            except Exception as e:
-                # 其他错误则抛出
-                print(f"Add member failed: {e}")
-                raise e
-    finally:
-        conn.close()
+    new_uid = int(new_uid)
+    with get_conn() as conn, conn.cursor() as cur:
+        # 权限判断和插入合成一条语句：操作者在群里才会插入，省一次往返，也没有先查后写的竞态
+        # ✨ 仍然不用 IGNORE（IGNORE 会把外键错误也吞掉），重复添加走下面的 IntegrityError
+        try:
+            cur.execute(
+                """
+                INSERT INTO dreams_conversation_members (conversation_id, uid)
+                SELECT %s, %s FROM DUAL
+                WHERE EXISTS (
+                    SELECT 1 FROM dreams_conversation_members WHERE conversation_id=%s AND uid=%s
+                )
+                """,
+                (cid, new_uid, cid, operator_uid),
+            )
+            conn.commit()
+        except pymysql.err.IntegrityError:
+            # 如果已经存在，直接忽略，不报错（相当于 IGNORE，但更可控）
+            return
+        except Exception as e:
+            # 其他错误则抛出
+            print(f"Add member failed: {e}")
+            raise e
+
+        if cur.rowcount == 0:
+            _set_membership(operator_uid, cid, False)
+            raise PermissionError("你不在群里")
+        _set_membership(new_uid, cid, True)
+
+def mark_read(uid: int, cid: int):
+    """标记会话已读：记录阅读时间并清零未读数"""
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE dreams_conversation_members 
+            SET last_read_at = NOW(), unread_count = 0
+            WHERE conversation_id = %s AND uid = %s
+            """,
+            (cid, uid)
+        )
+        conn.commit()
 
 def is_member(uid: int, cid: int) -> bool:
-    conn = get_conn()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1 FROM dreams_conversation_members WHERE conversation_id=%s AND uid=%s", (cid, uid))
-            return cur.fetchone() is not None
-    finally:
-        conn.close()
+    key = (uid, cid)
+    with _membership_lock:
+        cached = _membership_cache.get(key)
+    if cached is not None:
+        return cached
+
+    # EXISTS 找到第一行就停，只回一个布尔值；元组游标，不用为一个值建 dict
+    with get_conn() as conn, conn.cursor(pymysql.cursors.Cursor) as cur:
+        cur.execute(
+            "SELECT EXISTS(SELECT 1 FROM dreams_conversation_members WHERE conversation_id=%s AND uid=%s)",
+            (cid, uid),
+        )
+        result = bool(cur.fetchone()[0])
+    _set_membership(uid, cid, result)
+    return result
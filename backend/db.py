@@ -1,29 +1,88 @@
 import os
 import pymysql
 import ssl  # <--- 需要引入这个标准库
+import threading
+from dbutils.pooled_db import PooledDB
 
-def get_conn():
-    # ... 注释不变 ...
-    
-    # 检查是否需要 SSL（通常线上环境才需要）
+# =========================
+# 连接池
+# =========================
+# 每次 pymysql.connect 都要走一遍 TCP + 认证握手（线上还有 TLS），
+# 这里改成进程级连接池：get_conn() 拿到的是池里的连接代理，
+# 调用方原来的 finally: conn.close() 不用改，close 只是把连接还回池里。
+# 新代码直接写 with get_conn() as conn, conn.cursor() as cur: ...，退出时自动归还。
+
+# 检查是否需要 SSL（通常线上环境才需要）
+# 如果是在本地开发（没有 DB_USE_SSL 环境变量），就不传 ssl
+# 如果是在线上（设置了 DB_USE_SSL=true），就启用 ssl
+_ENABLE_SSL = os.getenv("DB_USE_SSL", "false").lower() == "true"
+
+
+def _create_ssl_context():
     # 大部分云厂商只需要一个空的 SSL 上下文即可骗过验证
+    # create_default_context 会加载系统 CA 证书，所以只在启用 SSL 时建一次，所有连接共用
     ssl_context = ssl.create_default_context()
     ssl_context.check_hostname = False
     ssl_context.verify_mode = ssl.CERT_NONE
-    
-    # 如果是在本地开发（没有 DB_USE_SSL 环境变量），就不传 ssl
-    # 如果是在线上（设置了 DB_USE_SSL=true），就启用 ssl
-    enable_ssl = os.getenv("DB_USE_SSL", "false").lower() == "true"
-    ssl_arg = ssl_context if enable_ssl else None
-
-    return pymysql.connect(
-        host=os.getenv("DB_HOST"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        database=os.getenv("DB_NAME"),
-        port=int(os.getenv("DB_PORT", 3306)),
-        charset="utf8mb4",
-        cursorclass=pymysql.cursors.DictCursor,
-        autocommit=True,
-        ssl=ssl_arg  # <--- 加上这个参数
+    return ssl_context
+
+
+_SSL_CTX = _create_ssl_context() if _ENABLE_SSL else None
+
+# 连接参数在导入时读一次，建池 / 重连时不再反复 getenv + int()
+_DB_HOST = os.getenv("DB_HOST")
+_DB_USER = os.getenv("DB_USER")
+_DB_PASSWORD = os.getenv("DB_PASSWORD")
+_DB_NAME = os.getenv("DB_NAME")
+_DB_PORT = int(os.getenv("DB_PORT", 3306))
+
+_POOL_MIN_CACHED = int(os.getenv("DB_POOL_MIN_CACHED", 5))
+_POOL_MAX_CACHED = int(os.getenv("DB_POOL_MAX_CACHED", 20))
+# 最大连接数和 worker 线程数保持在同一量级
+_POOL_MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX_CONNECTIONS", 50))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# 池连接和独立连接共用的参数
+_CONNECT_KWARGS = dict(
+    host=_DB_HOST,
+    user=_DB_USER,
+    password=_DB_PASSWORD,
+    database=_DB_NAME,
+    port=_DB_PORT,
+    charset="utf8mb4",
+    cursorclass=pymysql.cursors.DictCursor,
+    autocommit=True,
+    ssl=_SSL_CTX,  # <--- 加上这个参数
+)
+
+
+def _create_pool() -> PooledDB:
+    return PooledDB(
+        creator=pymysql,
+        mincached=_POOL_MIN_CACHED,
+        maxcached=_POOL_MAX_CACHED,
+        maxconnections=_POOL_MAX_CONNECTIONS,
+        blocking=True,  # 池满时排队等待，而不是直接报错
+        ping=1,         # 取出连接时检查是否还活着，断了会自动重连
+        **_CONNECT_KWARGS,
     )
+
+
+def get_conn():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _create_pool()
+    return _pool.connection()
+
+
+def connect_direct(**kwargs):
+    """
+    不走连接池的独立连接，给启动建表这类一次性操作用；
+    额外参数（例如 client_flag）原样传给 pymysql.connect，不会污染池里的连接
+    """
+    return pymysql.connect(**_CONNECT_KWARGS, **kwargs)
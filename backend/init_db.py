@@ -1,11 +1,16 @@
-from db import get_conn
+import os
+import pymysql
+from pymysql.constants import CLIENT
+from db import connect_direct
+from avatars import AVATAR_DIR, save_avatar_file
+from auth import SESSION_TTL_DAYS
 
 # =========================
 # 数据库初始化 DDL 列表
 # =========================
 DDL = [
     # 1. 用户表
-    # [变更]: avatar 改为 LONGTEXT (为了存 Base64 图片)，新增 gender
+    # [变更]: avatar 存 Base64 data URL，配置了 AVATAR_STORAGE_DIR 时存文件 URL；新增 gender
     """
     CREATE TABLE IF NOT EXISTS dreams_users (
         id INT PRIMARY KEY AUTO_INCREMENT,
@@ -30,7 +35,7 @@ DDL = [
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
     """,
 
-    # 3. 登录会话表 (保持不变)
+    # 3. 登录会话表
     """
     CREATE TABLE IF NOT EXISTS dreams_sessions (
         id BIGINT PRIMARY KEY AUTO_INCREMENT,
@@ -39,13 +44,16 @@ DDL = [
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         expires_at TIMESTAMP NULL,
         INDEX idx_uid (uid),
+        INDEX idx_expires (expires_at),
         CONSTRAINT fk_sessions_user
             FOREIGN KEY (uid) REFERENCES dreams_users(id) ON DELETE CASCADE
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
     """,
 
     # 4. 会话表
-    # [变更]: 新增 avatar (群头像 LONGTEXT), updated_at (排序用)
+    # [变更]: 新增 avatar (群头像，和用户头像一样存 data URL 或文件 URL), updated_at (排序用)
+    # [变更]: 新增 last_message_* 冗余列，会话列表不用再查消息表
+    # [变更]: 新增 private_pair_key ("小uid-大uid")，唯一索引保证两人之间只有一个私聊
     """
     CREATE TABLE IF NOT EXISTS dreams_conversations (
         id BIGINT PRIMARY KEY AUTO_INCREMENT,
@@ -53,10 +61,15 @@ DDL = [
         title VARCHAR(100) DEFAULT NULL,
         avatar LONGTEXT DEFAULT NULL,
         owner_uid INT DEFAULT NULL,
+        last_message_id BIGINT DEFAULT NULL,
+        last_message_at TIMESTAMP NULL DEFAULT NULL,
+        last_message_preview VARCHAR(255) DEFAULT NULL,
+        private_pair_key VARCHAR(32) DEFAULT NULL,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
         INDEX idx_type (type),
         INDEX idx_owner (owner_uid),
+        UNIQUE KEY uk_private_pair (private_pair_key),
         CONSTRAINT fk_conv_owner
             FOREIGN KEY (owner_uid) REFERENCES dreams_users(id) ON DELETE SET NULL
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
@@ -64,6 +77,8 @@ DDL = [
 
     # 5. 会话成员表
     # [变更]: 新增 last_read_at (红点), is_pinned (置顶), is_muted (免打扰)
+    # [变更]: 新增 unread_count (未读数冗余列，发消息时 +1，已读时清零)
+    # [变更]: 新增 sort_at (会话列表排序时间，发消息时刷新)，配合 idx_uid_sort 免排序
     """
     CREATE TABLE IF NOT EXISTS dreams_conversation_members (
         conversation_id BIGINT NOT NULL,
@@ -74,9 +89,12 @@ DDL = [
         last_read_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         is_pinned BOOLEAN DEFAULT FALSE,
         is_muted BOOLEAN DEFAULT FALSE,
+        unread_count INT NOT NULL DEFAULT 0,
+        sort_at TIMESTAMP NULL DEFAULT CURRENT_TIMESTAMP,
         
         PRIMARY KEY (conversation_id, uid),
         INDEX idx_uid (uid),
+        INDEX idx_uid_sort (uid, is_pinned, sort_at),
         CONSTRAINT fk_mem_conv
             FOREIGN KEY (conversation_id) REFERENCES dreams_conversations(id) ON DELETE CASCADE,
         CONSTRAINT fk_mem_user
@@ -98,49 +116,199 @@ DDL = [
         CONSTRAINT fk_msg_user
             FOREIGN KEY (sender_uid) REFERENCES dreams_users(id) ON DELETE CASCADE
     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """,
+
+    # 7. 已执行的升级步骤（见 MIGRATIONS）
+    """
+    CREATE TABLE IF NOT EXISTS dreams_schema_migrations (
+        name VARCHAR(100) PRIMARY KEY,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    """
+]
+
+# 预制“世界频道”，和建表语句一起发
+# [升级]: 显式指定 owner_uid=1，方便后续权限管理
+SEED = [
     """
+    INSERT IGNORE INTO dreams_conversations (id, type, title, owner_uid) 
+    VALUES (1, 'group', '🌍 世界频道', 1)
+    """,
+    # [升级] 确保 UID 1 是世界频道的群主：已经是成员就升级为 owner
+    # 如果数据库还是空的，IGNORE 会把外键错误降成警告，这一步不生效（直到有人注册），但这是安全的
+    """
+    INSERT IGNORE INTO dreams_conversation_members (conversation_id, uid, role) 
+    VALUES (1, 1, 'owner')
+    ON DUPLICATE KEY UPDATE role='owner'
+    """,
 ]
 
+def _batch(statements) -> str:
+    """把多条语句拼成一个多语句脚本（需要连接开启 MULTI_STATEMENTS）"""
+    return ";\n".join(s.strip().rstrip(";") for s in statements)
+
+# =========================
+# 老库升级语句
+# =========================
+# CREATE TABLE IF NOT EXISTS 不会改已有的表，新加的索引/列在这里补上。
+# 每一步（名字 + 若干条语句）成功后记到 dreams_schema_migrations，以后启动直接跳过：
+# 回填语句要扫全表，不能每个 worker 每次启动都跑一遍、拿着锁卡住启动。
+# 步骤中途失败不记录，下次启动整步重跑，所以每条语句都要能重复执行：
+# MySQL 不支持 ADD / DROP INDEX IF [NOT] EXISTS，“已存在 / 不存在”错误直接忽略，回填只处理还没填的行。
+MIGRATIONS = [
+    # token 上已经有 UNIQUE 索引，(token, uid) 索引是多余的，每次登录还要多维护一份
+    ("sessions_drop_idx_token_uid", [
+        "ALTER TABLE dreams_sessions DROP INDEX idx_token_uid",
+    ]),
+    ("sessions_expires", [
+        "ALTER TABLE dreams_sessions ADD INDEX idx_expires (expires_at)",
+        # 老会话没有过期时间，按创建时间 + 会话有效期补上（和新签发的 token 用同一个 SESSION_TTL_DAYS）
+        f"UPDATE dreams_sessions SET expires_at = created_at + INTERVAL {SESSION_TTL_DAYS:d} DAY WHERE expires_at IS NULL",
+    ]),
+    ("conversations_last_message", [
+        "ALTER TABLE dreams_conversations ADD COLUMN last_message_id BIGINT DEFAULT NULL",
+        "ALTER TABLE dreams_conversations ADD COLUMN last_message_at TIMESTAMP NULL DEFAULT NULL",
+        "ALTER TABLE dreams_conversations ADD COLUMN last_message_preview VARCHAR(255) DEFAULT NULL",
+        # 老会话回填最后一条消息
+        """
+        UPDATE dreams_conversations c
+        JOIN (
+            SELECT conversation_id, MAX(id) AS last_id
+            FROM dreams_messages GROUP BY conversation_id
+        ) lt ON lt.conversation_id = c.id
+        JOIN dreams_messages msg ON msg.id = lt.last_id
+        SET c.last_message_id = msg.id,
+            c.last_message_at = msg.created_at,
+            c.last_message_preview = LEFT(msg.content, 255)
+        WHERE c.last_message_id IS NULL
+        """,
+    ]),
+    ("conversations_private_pair_key", [
+        "ALTER TABLE dreams_conversations ADD COLUMN private_pair_key VARCHAR(32) DEFAULT NULL",
+        "ALTER TABLE dreams_conversations ADD UNIQUE KEY uk_private_pair (private_pair_key)",
+        # 老私聊回填 pair key；历史上重复建出来的私聊只有第一个能拿到 key，其余由 IGNORE 跳过
+        """
+        UPDATE IGNORE dreams_conversations c
+        JOIN (
+            SELECT conversation_id, CONCAT(MIN(uid), '-', MAX(uid)) AS pair_key
+            FROM dreams_conversation_members
+            GROUP BY conversation_id
+        ) p ON p.conversation_id = c.id
+        SET c.private_pair_key = p.pair_key
+        WHERE c.type = 'private' AND c.private_pair_key IS NULL
+        """,
+    ]),
+    ("members_unread_count", [
+        "ALTER TABLE dreams_conversation_members ADD COLUMN unread_count INT NOT NULL DEFAULT 0",
+        # 回填未读数：只算 unread_count 还是 0 但其实有别人新消息的行，重复执行结果不变
+        """
+        UPDATE dreams_conversation_members m
+        JOIN (
+            SELECT mm.conversation_id, mm.uid, COUNT(*) AS cnt
+            FROM dreams_conversation_members mm
+            JOIN dreams_messages msg
+                ON msg.conversation_id = mm.conversation_id
+                AND msg.created_at > mm.last_read_at
+                AND msg.sender_uid != mm.uid
+            WHERE mm.unread_count = 0
+            GROUP BY mm.conversation_id, mm.uid
+        ) u ON u.conversation_id = m.conversation_id AND u.uid = m.uid
+        SET m.unread_count = u.cnt
+        """,
+    ]),
+    # 排序时间：先加成可空列，回填完再补默认值（回填只处理 NULL 行）；依赖上面的 last_message_at
+    ("members_sort_at", [
+        "ALTER TABLE dreams_conversation_members ADD COLUMN sort_at TIMESTAMP NULL DEFAULT NULL",
+        """
+        UPDATE dreams_conversation_members m
+        JOIN dreams_conversations c ON c.id = m.conversation_id
+        SET m.sort_at = COALESCE(c.last_message_at, c.updated_at)
+        WHERE m.sort_at IS NULL
+        """,
+        "ALTER TABLE dreams_conversation_members MODIFY COLUMN sort_at TIMESTAMP NULL DEFAULT CURRENT_TIMESTAMP",
+        "ALTER TABLE dreams_conversation_members ADD INDEX idx_uid_sort (uid, is_pinned, sort_at)",
+    ]),
+    # 有一段时间新建的库 avatar 是 VARCHAR(255)，放不下 data URL
+    ("avatar_longtext", [
+        "ALTER TABLE dreams_users MODIFY COLUMN avatar LONGTEXT DEFAULT NULL",
+        "ALTER TABLE dreams_conversations MODIFY COLUMN avatar LONGTEXT DEFAULT NULL",
+    ]),
+]
+
+# 1060: 列已存在, 1061: 索引名已存在, 1091: 要删的索引不存在
+_IGNORABLE_MIGRATION_ERRORS = (1060, 1061, 1091)
+
+def _run_migrations(cur):
+    cur.execute("SELECT name FROM dreams_schema_migrations")
+    applied = {r["name"] for r in cur.fetchall()}
+    for name, statements in MIGRATIONS:
+        if name in applied:
+            continue
+        for sql in statements:
+            try:
+                cur.execute(sql)
+            except pymysql.err.OperationalError as e:
+                if e.args[0] not in _IGNORABLE_MIGRATION_ERRORS:
+                    raise
+        # 多个 worker 同时启动可能都跑了同一步，IGNORE 掉重复记录
+        cur.execute("INSERT IGNORE INTO dreams_schema_migrations (name) VALUES (%s)", (name,))
+
+# 老数据里内联的 Base64 头像搬到文件里，表里换成 URL
+# 会覆盖数据库里唯一的一份图片，所以要显式打开：AVATAR_MIGRATE_INLINE=true，
+# 并且 AVATAR_STORAGE_DIR 是持久化存储
+# 先只查 id，再逐行取大字段，避免一次把所有图片读进内存
+_INLINE_AVATAR_TABLES = ("dreams_users", "dreams_conversations")
+AVATAR_MIGRATE_INLINE = os.getenv("AVATAR_MIGRATE_INLINE", "false").lower() == "true"
+
+def _migrate_inline_avatars(cur):
+    if not (AVATAR_MIGRATE_INLINE and AVATAR_DIR):
+        return
+    for table in _INLINE_AVATAR_TABLES:
+        cur.execute(f"SELECT id FROM {table} WHERE avatar LIKE 'data:%'")
+        ids = [r["id"] for r in cur.fetchall()]
+        for row_id in ids:
+            cur.execute(f"SELECT avatar FROM {table} WHERE id=%s", (row_id,))
+            try:
+                url = save_avatar_file(cur.fetchone()["avatar"])
+            except ValueError:
+                # 解不出来的图保持原样，前端照样能当 data URL 显示
+                continue
+            cur.execute(f"UPDATE {table} SET avatar=%s WHERE id=%s", (url, row_id))
+
 # =========================
 # 数据库初始化入口函数
 # =========================
+_initialized = False
+
 def init_db():
-    conn = get_conn()
+    # 同一进程只初始化一次（重复 import / 手动调用都不会再跑一遍）
+    global _initialized
+    if _initialized:
+        return
+
+    # 建表 + 种子数据拼成一个脚本一次发过去，启动时只有一次往返；
+    # 只有这条独立连接开 MULTI_STATEMENTS，池里的业务连接不受影响
+    # 失败必须抛出去让启动失败：没有表 / 只建了一半的表还接着跑，之后每个请求都会出错
     try:
-        with conn.cursor() as cur:
-            # 1. 执行建表
-            for sql in DDL:
-                cur.execute(sql)
-            
-            # 2. 预制“世界频道”
-            # [升级]: 显式指定 owner_uid=1，方便后续权限管理
-            cur.execute(
-                """
-                INSERT IGNORE INTO dreams_conversations (id, type, title, owner_uid) 
-                VALUES (1, 'group', '🌍 世界频道', 1)
-                """
-            )
-            
-            # 3. [升级] 确保 UID 1 是世界频道的群主
-            # 如果数据库还是空的，这一步可能不生效（直到有人注册），但这是安全的
-            try:
-                cur.execute("""
-                    INSERT IGNORE INTO dreams_conversation_members (conversation_id, uid, role) 
-                    VALUES (1, 1, 'owner')
-                """)
-                # 如果已经是成员，强制升级为 owner
-                cur.execute("UPDATE dreams_conversation_members SET role='owner' WHERE conversation_id=1 AND uid=1")
-                conn.commit()
-            except Exception:
-                pass 
-
-            print("✅ Database initialized successfully (Tables updated, World Channel ready).")
+        conn = connect_direct(client_flag=CLIENT.MULTI_STATEMENTS)
+        try:
+            with conn.cursor() as cur:
+                # 1. 执行建表 + 2. 预制“世界频道”及群主
+                cur.execute(_batch(DDL + SEED))
+                while cur.nextset():
+                    pass
 
+                # 升级语句要逐条执行（单条出错要单独忽略），不能拼进脚本
+                _run_migrations(cur)
+                _migrate_inline_avatars(cur)
+        finally:
+            conn.close()
     except Exception as e:
         print(f"❌ Database init failed: {e}")
-        # raise e # 可以注释掉，防止卡住部署日志
-    finally:
-        conn.close()
+        raise
+
+    _initialized = True
+    print("✅ Database initialized successfully (Tables updated, World Channel ready).")
 
 if __name__ == "__main__":
     init_db()
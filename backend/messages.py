@@ -1,36 +1,144 @@
-from typing import List, Dict
+import pymysql
+import time
+from collections import Counter
+from typing import List, Dict, Iterable, Optional, Tuple
 from db import get_conn
 
 
-def save_message(conversation_id: int, sender_uid: int, content: str) -> int:
+def save_messages(batch: Iterable[Tuple[int, int, str]]) -> List[int]:
     """
-    保存一条聊天消息到数据库
+    批量保存聊天消息，batch 里每项是 (conversation_id, sender_uid, content)，返回消息 id 列表
+    整批在一个事务里提交；同一事务里刷新 dreams_conversations 上的“最后一条消息”冗余列
+    和成员未读数 / 排序时间，会话列表就不用再去 dreams_messages 里找最新消息、数未读。
+    冗余列按会话 / 发送者合并更新，不是每条消息都更新一遍
     """
+    batch = list(batch)
+    message_ids = []
+    last_ids: Dict[int, int] = {}
+    sent = Counter()
+
     conn = get_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                INSERT INTO dreams_messages (conversation_id, sender_uid, content)
-                VALUES (%s, %s, %s)
-                """,
-                (conversation_id, sender_uid, content),
-            )
-            return cur.lastrowid
+            conn.begin()
+            try:
+                for conversation_id, sender_uid, content in batch:
+                    cur.execute(
+                        """
+                        INSERT INTO dreams_messages (conversation_id, sender_uid, content)
+                        VALUES (%s, %s, %s)
+                        """,
+                        (conversation_id, sender_uid, content),
+                    )
+                    message_ids.append(cur.lastrowid)
+                    last_ids[conversation_id] = cur.lastrowid
+                    sent[(conversation_id, sender_uid)] += 1
+
+                # 按 conversation_id 升序加锁：多个 worker 同时落库时加锁顺序一致，不会互相死锁
+                for conversation_id in sorted(last_ids):
+                    message_id = last_ids[conversation_id]
+                    cur.execute(
+                        """
+                        UPDATE dreams_conversations c
+                        JOIN dreams_messages msg ON msg.id = %s
+                        SET c.last_message_id = msg.id,
+                            c.last_message_at = msg.created_at,
+                            c.last_message_preview = LEFT(msg.content, 255)
+                        WHERE c.id = %s
+                        """,
+                        (message_id, conversation_id),
+                    )
+                # 除发送者外，其他成员未读数 + 该发送者这批发的条数；所有成员的排序时间刷新
+                for (conversation_id, sender_uid), count in sorted(sent.items()):
+                    cur.execute(
+                        """
+                        UPDATE dreams_conversation_members
+                        SET unread_count = unread_count + %s * (uid != %s),
+                            sort_at = NOW()
+                        WHERE conversation_id = %s
+                        """,
+                        (count, sender_uid, conversation_id),
+                    )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return message_ids
     finally:
         conn.close()
 
 
-def list_recent_messages(conversation_id: int, limit: int = 50) -> List[Dict]:
+# 整批重试的次数；锁等待超时(1205) / 死锁(1213) / 连接断开都是 OperationalError，
+# 事务已经整个回滚，退避一下原样重试通常就能写进去
+SAVE_RETRIES = 3
+SAVE_RETRY_BACKOFF = 0.05  # 秒，每次翻倍
+
+
+def save_messages_with_retry(batch: Iterable[Tuple[int, int, str]]) -> int:
+    """
+    后台落库用的 save_messages，返回实际写入的条数，不抛异常
+    - 临时错误：退避后整批重试
+    - 数据错误（IntegrityError / DataError，比如会话已被删除）或重试用完：改成逐条写，
+      只丢掉写不进去的那几条，并逐条记日志
+    """
+    batch = list(batch)
+    for attempt in range(SAVE_RETRIES):
+        try:
+            save_messages(batch)
+            return len(batch)
+        except (pymysql.err.IntegrityError, pymysql.err.DataError) as e:
+            print(f"Save messages failed, retrying row by row: {e}")
+            break
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError) as e:
+            print(f"Save messages failed (attempt {attempt + 1}/{SAVE_RETRIES}): {e}")
+            time.sleep(SAVE_RETRY_BACKOFF * 2 ** attempt)
+        except Exception as e:
+            print(f"Save messages failed, retrying row by row: {e}")
+            break
+
+    saved = 0
+    for item in batch:
+        try:
+            save_messages([item])
+            saved += 1
+        except Exception as e:
+            print(f"Save message dropped (conversation {item[0]}, sender {item[1]}): {e}")
+    return saved
+
+
+def list_recent_messages(conversation_id: int, limit: int = 50, before_id: Optional[int] = None) -> List[Dict]:
     """
     获取指定会话的最近消息列表
     ✨ 核心修改：关联 dreams_users 表，获取头像(avatar)和用户名(username)
+    before_id: 翻页用，只取这条消息之前的消息（keyset 分页，页数再深也不用 OFFSET 跳行）
     """
+    # 翻页时按 (created_at, id) 比较；锚点消息按主键 JOIN 进来，是常量表，
+    # 比较条件可以直接变成 idx_conv_time 上的范围扫描
+    before_join, before_where, params = "", "", []
+    if before_id is not None:
+        before_join = "JOIN dreams_messages b ON b.id = %s AND b.conversation_id = m.conversation_id"
+        before_where = "AND (m.created_at < b.created_at OR (m.created_at = b.created_at AND m.id < b.id))"
+        params.append(before_id)
+    params += [conversation_id, limit]
+
     conn = get_conn()
     try:
         with conn.cursor() as cur:
+            # 锚点必须是本会话的消息：别的会话的 id 直接报错，不要悄悄返回空页；
+            # 翻到最早一条之后再往前翻则是正常的空页
+            if before_id is not None:
+                cur.execute(
+                    "SELECT EXISTS(SELECT 1 FROM dreams_messages WHERE id=%s AND conversation_id=%s) AS ok",
+                    (before_id, conversation_id),
+                )
+                if not cur.fetchone()["ok"]:
+                    raise ValueError("before_id does not belong to this conversation")
+
+            # idx_conv_time (conversation_id, created_at) 在 InnoDB 里隐含带上主键 id，
+            # 所以按 (created_at, id) 倒序也是直接倒着扫索引、拿够 LIMIT 条就停，不用 filesort；
+            # id 兜底同一秒内的先后顺序（批量落库时同一秒会有很多条）
             cur.execute(
-                """
+                f"""
                 SELECT 
                     m.id, 
                     m.conversation_id, 
@@ -40,16 +148,19 @@ def list_recent_messages(conversation_id: int, limit: int = 50) -> List[Dict]:
                     u.username as sender_username,
                     u.avatar as sender_avatar
                 FROM dreams_messages m
+                {before_join}
                 LEFT JOIN dreams_users u ON m.sender_uid = u.id
-                WHERE m.conversation_id=%s
-                ORDER BY m.created_at DESC
+                WHERE m.conversation_id=%s {before_where}
+                ORDER BY m.created_at DESC, m.id DESC
                 LIMIT %s
                 """,
-                (conversation_id, limit),
+                params,
             )
-            rows = cur.fetchall()
+            # 没有结果时 fetchall() 返回的是空元组，不能原地 reverse，统一转成 list
+            rows = list(cur.fetchall())
 
             # 前端通常希望消息是从旧到新排列
-            return list(reversed(rows))
+            rows.reverse()
+            return rows
     finally:
         conn.close()
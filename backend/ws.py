@@ -1,7 +1,20 @@
-import json
-from typing import Dict, List
+import asyncio
+import os
+import re
+import orjson
+from dataclasses import dataclass
+from typing import Dict
 from fastapi import WebSocket
 
+# 配了 REDIS_URL 就通过 Redis pub/sub 广播，多个 worker / 实例之间也能互相收到消息；
+# 没配就只在本进程内广播（单 worker 部署不需要 Redis）
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_CHANNEL_PREFIX = "dreams:chat:"
+
+
+# 移动端关键字合成一个正则，一次扫描 User-Agent
+_MOBILE_UA_RE = re.compile(r"iphone|android|ipad|mobile", re.IGNORECASE)
+
 
 def detect_device(ws: WebSocket) -> str:
     """
@@ -14,12 +27,19 @@ def detect_device(ws: WebSocket) -> str:
     返回值：
     - "mobile" 或 "desktop"
     """
-    ua = (ws.headers.get("user-agent") or "").lower()
-    if any(k in ua for k in ["iphone", "android", "ipad", "mobile"]):
+    ua = ws.headers.get("user-agent") or ""
+    if _MOBILE_UA_RE.search(ua):
         return "mobile"
     return "desktop"
 
 
+@dataclass(slots=True)
+class Connection:
+    """在线连接的附带信息；用 slots，每个连接比一个 dict 省不少内存"""
+    uid: int
+    device: str
+
+
 class WSManager:
     """
     WebSocket 会话管理器
@@ -27,26 +47,78 @@ class WSManager:
     内部结构说明：
     - self.rooms 是一个 dict
     - key: conversation_id
-    - value: 一个 list，每一项代表一个在线连接
+    - value: 一个 dict，key 是 WebSocket 对象，value 是这个连接的信息
 
-    list 中的每一项结构：
-    {
-        "ws": WebSocket 对象,
-        "uid": 用户 ID,
-        "device": "mobile" 或 "desktop"
-    }
+    连接信息结构（Connection）：
+    - uid: 用户 ID
+    - device: "mobile" 或 "desktop"
 
     说明：
-    - 这个管理器只存在于内存中
+    - 连接只存在于本进程内存中
     - 服务重启后，所有连接都会断开
-    - 不做跨进程 / 多实例同步
+    - 配置了 REDIS_URL 时，广播先发到 Redis 频道 dreams:chat:<conversation_id>，
+      每个进程订阅所有频道，再推给自己手上的连接；否则只在本进程内广播
+    - 用 dict 按连接索引，加入 / 离开都是 O(1)，不用每次离开都重建整个列表
     """
 
     def __init__(self):
         # 保存所有会话的在线 WebSocket 连接
-        self.rooms: Dict[int, List[dict]] = {}
+        self.rooms: Dict[int, Dict[WebSocket, Connection]] = {}
+        self._redis = None
+        self._listener = None
+        # 每个房间最后一个还没发完的推送任务，同一房间的消息排在它后面发，保证顺序
+        self._room_tails: Dict[int, asyncio.Task] = {}
+
+    async def start(self):
+        """应用启动时调用：配置了 Redis 就连上并开始订阅"""
+        if not REDIS_URL:
+            return
+        import redis.asyncio as aioredis
+
+        self._redis = aioredis.from_url(REDIS_URL)
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        """应用关闭时调用"""
+        if self._listener is not None:
+            self._listener.cancel()
+        if self._redis is not None:
+            await self._redis.aclose()
+
+    async def _listen(self):
+        """订阅所有会话频道，把别的进程发来的消息推给本进程的连接；断线后自动重连"""
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.psubscribe(REDIS_CHANNEL_PREFIX + "*")
+                    async for m in pubsub.listen():
+                        if m["type"] != "pmessage":
+                            continue
+                        conversation_id = int(m["channel"][len(REDIS_CHANNEL_PREFIX):])
+                        self._dispatch(conversation_id, m["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Redis subscriber failed: {e}")
+                await asyncio.sleep(1)
+
+    def _dispatch(self, conversation_id: int, msg: str):
+        """
+        订阅者收到消息后不在原地等着发完：每条消息起一个任务推送，
+        一个房间里有慢连接只拖住这个房间，不会卡住其它房间的推送；
+        同一房间的任务接在上一个后面，消息不会乱序
+        """
+        prev = self._room_tails.get(conversation_id)
+        task = asyncio.create_task(self._send_after(prev, conversation_id, msg))
+        self._room_tails[conversation_id] = task
+        task.add_done_callback(lambda t: self._room_tails.get(conversation_id) is t and self._room_tails.pop(conversation_id))
+
+    async def _send_after(self, prev, conversation_id: int, msg: str):
+        if prev is not None:
+            await asyncio.wait((prev,))
+        await self._send_local(conversation_id, msg)
 
-    async def join(self, conversation_id: int, ws: WebSocket, uid: int):
+    async def join(self, conversation_id: int, ws: WebSocket, uid: int, device: str = None):
         """
         将一个 WebSocket 连接加入指定会话
 
@@ -54,15 +126,12 @@ class WSManager:
         - conversation_id: 会话 ID
         - ws: WebSocket 连接对象
         - uid: 当前用户 ID
+        - device: 调用方已经算好的设备类型（不传则根据 User-Agent 判断）
         """
-        device = detect_device(ws)
+        device = device or detect_device(ws)
 
         # 如果该会话还没有房间，则先创建
-        self.rooms.setdefault(conversation_id, []).append({
-            "ws": ws,
-            "uid": uid,
-            "device": device
-        })
+        self.rooms.setdefault(conversation_id, {})[ws] = Connection(uid, device)
 
     def leave(self, conversation_id: int, ws: WebSocket):
         """
@@ -72,17 +141,14 @@ class WSManager:
         - conversation_id: 会话 ID
         - ws: 要移除的 WebSocket 连接
         """
-        if conversation_id not in self.rooms:
+        room = self.rooms.get(conversation_id)
+        if room is None:
             return
 
-        # 过滤掉当前 ws
-        self.rooms[conversation_id] = [
-            c for c in self.rooms[conversation_id]
-            if c["ws"] != ws
-        ]
+        room.pop(ws, None)
 
         # 如果该会话已经没有任何在线连接，清理掉整个房间
-        if not self.rooms[conversation_id]:
+        if not room:
             del self.rooms[conversation_id]
 
     async def broadcast(self, conversation_id: int, payload: dict):
@@ -94,29 +160,56 @@ class WSManager:
         - payload: 要发送的数据（dict，会被序列化成 JSON）
 
         行为说明：
-        - 逐个向房间内的 WebSocket 发送消息
+        - 只序列化一次；配置了 Redis 时发布到会话频道，由各进程的订阅者推送（包括本进程）
+        - 否则直接推给本进程的连接
+        - Redis 发布失败不抛给调用方：退回只推本进程的连接，别的 worker 上的人这条收不到
+        """
+        # 将消息序列化为 JSON 字符串
+        # orjson 输出 UTF-8 bytes（中文不转义），前端按文本帧解析，所以 decode 后 send_text
+        msg = orjson.dumps(payload).decode()
+
+        if self._redis is not None:
+            try:
+                await self._redis.publish(f"{REDIS_CHANNEL_PREFIX}{conversation_id}", msg)
+                return
+            except Exception as e:
+                print(f"Redis publish failed, delivering locally only: {e}")
+
+        await self._send_local(conversation_id, msg)
+
+    async def _send_local(self, conversation_id: int, msg: str):
+        """
+        向本进程内该会话的所有连接发送已经序列化好的消息
+
+        - 同时向房间内的所有 WebSocket 发送消息（asyncio.gather），
+          总耗时取决于最慢的那个连接，而不是所有连接耗时之和
         - 如果某个连接发送失败，认为该连接已失效
         - 失效连接会被自动移除
         """
         if conversation_id not in self.rooms:
             return
 
-        # 将消息序列化为 JSON 字符串
-        msg = json.dumps(payload, ensure_ascii=False)
-
-        dead = []
+        # 先拷贝一份连接列表，发送过程中有人加入 / 离开也不影响
+        targets = tuple(self.rooms[conversation_id])
 
-        # 尝试向所有连接发送消息
-        for c in self.rooms[conversation_id]:
+        # 私聊 / 只有一个人在线时房间里只有一个连接，直接发，不用走 gather
+        # （发送者自己也要收到回显，前端靠它显示自己发的消息，所以不能跳过）
+        if len(targets) == 1:
             try:
-                await c["ws"].send_text(msg)
+                await targets[0].send_text(msg)
             except Exception:
-                # 发送失败的连接，标记为失效
-                dead.append(c["ws"])
+                self.leave(conversation_id, targets[0])
+            return
+
+        results = await asyncio.gather(
+            *(ws.send_text(msg) for ws in targets),
+            return_exceptions=True,
+        )
 
-        # 清理所有失效连接
-        for ws in dead:
-            self.leave(conversation_id, ws)
+        # 清理所有发送失败（已失效）的连接
+        for ws, result in zip(targets, results):
+            if isinstance(result, Exception):
+                self.leave(conversation_id, ws)
 
 
 # 全局 WebSocket 管理器实例
@@ -13,8 +13,18 @@ const Dreams = {
   setUid: (uid) => localStorage.setItem("dreams_uid", String(uid)),
   getUid: () => localStorage.getItem("dreams_uid"),
 
-  // 登出：清除数据并跳回登录页
+  // 登出：通知后端吊销 token，清除数据并跳回登录页
   logout: () => {
+    const token = Dreams.getToken();
+    if (token) {
+      // keepalive：页面马上跳转，请求也能发出去；失败了不影响本地登出
+      fetch(API_BASE + "/api/logout", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ token }),
+        keepalive: true,
+      }).catch(() => {});
+    }
     localStorage.removeItem("dreams_token");
     localStorage.removeItem("dreams_uid");
     // 只有当前不在登录页时才跳转，防止死循环